@@ -1,3 +1,6 @@
+from tinydb import where
+
+
 def get_structures_from_database(db, prototype, subl_model, subl_site_ratios):
     """Returns a list of Structure objects from the db that match the criteria.
 
@@ -37,19 +40,23 @@ def get_structures_from_database(db, prototype, subl_model, subl_site_ratios):
 
         """
         # can we compare these two lists?
-        if len(l1) != len(l2):
+        if len(l1) != len(l2) or len(l1) == 0:
             return False
-        for a, b in [(l1, l2), (l2, l1)]:  # check the reverse of the lists too
-            # see if all a are perfectly divisible by all b
-            if all([(x % y == 0) for x, y in zip(a, b)]):
-                # see if all have the same multiple
-                if len(set([x/y for x, y in zip(a, b)])) == 1:
-                    return True
-        return False
-
-    from tinydb import where
+        # only the list with the larger sum can be a multiple of the other
+        a, b = (l1, l2) if sum(l1) >= sum(l2) else (l2, l1)
+        q, r = divmod(a[0], b[0])
+        if r or q == 0:
+            return False
+        return all(x == q * y for x, y in zip(a, b))
+
+    num_subl = len(subl_site_ratios)
+
+    def matches_site_ratios(x):
+        # reject sublattice models of the wrong size before summing any sites
+        if len(x) != num_subl:
+            return False
+        return lists_are_multiple([sum(subl) for subl in x], subl_site_ratios)
+
     results = db.search((where('prototype') == prototype) &
-                        (where('sublattice_site_ratios').test(
-                         lambda x: (lists_are_multiple([sum(subl) for subl in x], subl_site_ratios))))
-              )
+                        (where('sublattice_site_ratios').test(matches_site_ratios)))
     return results
\ No newline at end of file
@@ -1,10 +1,9 @@
 """Convienence functions for building dilute structures"""
-from pymatgen.core import Structure
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.core.periodic_table import Element
 from itertools import permutations, product, chain
 from collections import Counter
-import copy
+import numpy as np
 
 def dilute_substitution(endmembers, sublattice_dict, supercell_matrix=None):
     """
@@ -24,48 +23,64 @@ def dilute_substitution(endmembers, sublattice_dict, supercell_matrix=None):
     
     dilute sublattice configurations
     """
+    def sublattice_configuration(num, sub_lattice_list, site_ele):
+        """
+        Return the configuration of each sublattice from the first two sites of its block
+
+        Parameters
+        ----------
+        num: list of indices of the first site of each sublattice block
+
+        sub_lattice_list: list of sublattice names for each site
+
+        site_ele: dict of {site index: element} for the sites in num and the sites following them
+
+        Returns
+        -------
+        comb: dict
+            Element on each sublattice, or a list of two elements for the substituted sublattice
+        """
+        comb={}
+        for i in num:
+            sfirst_ele=site_ele[i]
+            ssecond_ele=site_ele[i+1]
+            site_sub=sub_lattice_list[i]
+            if sfirst_ele == ssecond_ele:
+                comb[site_sub]=sfirst_ele
+            else:
+                comb[site_sub]=[sfirst_ele, ssecond_ele]
+        return comb
+
     dilute_strs=[]
     dilute_conf=[]
-    structures=copy.deepcopy(endmembers)
+    structures=[e.copy() for e in endmembers]
     if supercell_matrix is not None:
         for i in structures:
             i.make_supercell(supercell_matrix)
     for strs in structures:
-        dictstr=strs.as_dict()
-        sub_lattice_list=[]
-        for i in dictstr['sites']:
-            j=i['properties']['sublattice_sites']
-            sub_lattice_list.append(j)
-        num=[]
-        for i in range(0, len(sub_lattice_list)):
-            if i != len(sub_lattice_list):
-                if sub_lattice_list[i] != sub_lattice_list[i-1]:
-                    num.append(i)          
+        sub_lattice_list=[site.properties['sublattice_sites'] for site in strs.sites]
+        # index of the first site of every sublattice block; the first site always starts one
+        # (comparing it against the last site could drop it for a single-sublattice structure)
+        label_index={}
+        labels=np.fromiter((label_index.setdefault(subl, len(label_index)) for subl in sub_lattice_list),
+                           dtype=np.int64, count=len(sub_lattice_list))
+        num=[0]+(np.flatnonzero(labels[1:] != labels[:-1])+1).tolist()
+        # endmember elements on the sites the configurations are read from
+        endmember_ele={k: strs[k].specie.symbol for i in num for k in (i, i+1)}
         for i in num:
-            dictstr=strs.as_dict()
-            old_ele=dictstr['sites'][i]['species'][0]['element']
-            site_sub=dictstr['sites'][i]['properties']['sublattice_sites']
+            old_site=strs[i]
+            old_ele=endmember_ele[i]
             sublattice_num=sub_lattice_list[i]
             element_dict=sublattice_dict[sublattice_num]
             for j in element_dict:
                 if j != 'fix':
                     if old_ele != j:
-                        dictstr['sites'][i]['species'][0]['element']=j
-                        dilute_strs.append(Structure.from_dict(dictstr))
-                                      
-    for dilute in dilute_strs:
-        comb={}
-        dictdilute=dilute.as_dict()
-        for i in num:
-            sfirst_ele=dictdilute['sites'][i]['species'][0]['element']
-            ssecond_ele=dictdilute['sites'][i+1]['species'][0]['element']
-            site_sub=dictdilute['sites'][i]['properties']['sublattice_sites']
-            if sfirst_ele == ssecond_ele:
-                comb[site_sub]=sfirst_ele
-            else:
-                conflist=list()
-                conflist.append(sfirst_ele)
-                conflist.append(ssecond_ele)
-                comb[site_sub]=conflist
-        dilute_conf.append(comb)
+                        # substitute the single site on a copy, keeping its sublattice label
+                        dilute=strs.copy()
+                        dilute.replace(i, j, properties=dict(old_site.properties))
+                        dilute_strs.append(dilute)
+                        # the configuration follows from the endmember and the substitution alone
+                        dilute_ele=dict(endmember_ele)
+                        dilute_ele[i]=j
+                        dilute_conf.append(sublattice_configuration(num, sub_lattice_list, dilute_ele))
     return dilute_strs, dilute_conf
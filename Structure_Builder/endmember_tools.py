@@ -4,6 +4,7 @@ from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.core.periodic_table import Element
 from itertools import permutations, product, chain
 from collections import Counter
+from structure_tools import substitute_configuration
 
 def get_sublattice_information(structure, use_equivalent_atom=False):
     """
@@ -33,10 +34,13 @@ def get_sublattice_information(structure, use_equivalent_atom=False):
     Note:
     Need to consider order-disorder case
     """
-    structure.replace_species({sp.name: "H" for sp in structure.species})
-    sga = SpacegroupAnalyzer(structure)
-    wyckoff_sites = sga.get_symmetry_dataset()['wyckoffs']
-    equal_atom = sga.get_symmetry_dataset()['equivalent_atoms']
+    # work on a copy so the caller's structure keeps its species
+    h_structure = structure.copy()
+    h_structure.replace_species({sp.name: "H" for sp in h_structure.species})
+    sga = SpacegroupAnalyzer(h_structure)
+    symmetry_dataset = sga.get_symmetry_dataset()
+    wyckoff_sites = symmetry_dataset['wyckoffs']
+    equal_atom = symmetry_dataset['equivalent_atoms']
     num_wyckoff_sites = sorted(set(wyckoff_sites))
     num_eq_atom=sorted(set(equal_atom))
     if len(num_wyckoff_sites)!=len(num_eq_atom):
@@ -46,12 +50,11 @@ def get_sublattice_information(structure, use_equivalent_atom=False):
         for i in num_eq_atom:
             sub_wyckoff_name.append(wyckoff_sites[i])
         replace_list=[]
-        original_list=[]
+        seen_subl=Counter()
         for i in sub_wyckoff_name:
-            original_list.append(i)
-            if i in replace_list:
-                count_subl=dict(Counter(original_list))
-                j=i+str(count_subl[i])
+            seen_subl[i]+=1
+            if seen_subl[i] > 1:
+                j=i+str(seen_subl[i])
             else:
                 j=i
             replace_list.append(j)
@@ -60,10 +63,8 @@ def get_sublattice_information(structure, use_equivalent_atom=False):
     else:
         true_sublattice_sites = wyckoff_sites
     subl_model_name = sorted(set(true_sublattice_sites))
-    sublattice_site_ratio=[]
-    for i in subl_model_name:
-        j=true_sublattice_sites.count(i)
-        sublattice_site_ratio.append(j)
+    site_count=Counter(true_sublattice_sites)
+    sublattice_site_ratio=[site_count[i] for i in subl_model_name]
     return true_sublattice_sites, subl_model_name, sublattice_site_ratio
 
 def get_templates(structure, wyckoff_site_list, subl_model_name, equivalent_sites=None):
@@ -98,20 +99,14 @@ def get_templates(structure, wyckoff_site_list, subl_model_name, equivalent_site
         true_sublattice_sites=wyckoff_site_list
         rep_sublattices=subl_model_name
     true_sublattices=sorted(set(rep_sublattices))
-    site_list=[]
+    # map every sublattice to its placeholder element up front, so a placeholder (e.g. 'H')
+    # can never be mistaken for a sublattice name while the sites are being rewritten
+    template_element={subl: str(Element.from_Z(i+1)) for i, subl in enumerate(true_sublattices)}
+    template_configuration=[template_element[subl] for subl in true_sublattices]
     dict_struct=structure.as_dict()
-    for i in true_sublattice_sites:
-        site_dict={'sublattice_sites':i}
-        site_list.append(site_dict)
-    for i in range(0,len(dict_struct['sites'])):
-        dict_struct['sites'][i]['properties'].update(site_list[i])
-        dict_struct['sites'][i]['species'][0]['element']=site_list[i]['sublattice_sites']
-    template_configuration=[]
-    for i in range(0,len(true_sublattices)):
-        for element in dict_struct['sites']:
-            if element['species'][0]['element']==true_sublattices[i]:
-                element['species'][0]['element'] = str(Element.from_Z(i+1))
-        template_configuration.append(str(Element.from_Z(i+1)))
+    for site, subl in zip(dict_struct['sites'], true_sublattice_sites):
+        site['properties']['sublattice_sites']=subl
+        site['species'][0]['element']=template_element.get(subl, subl)
     template_structure=Structure.from_dict(dict_struct)
     return template_structure, template_configuration
 
@@ -129,18 +124,33 @@ def get_endmembers_with_templates(template_structure, template_configuration, su
         element for each sublattice. If input manually, make sure be consistent with the sublattice_model_name 
 
     sublattice_configuration: list
-        List of configurations for each sublattice
+        List of configurations for each sublattice, in the same order as template_configuration
 
     Returns
     -------
+    subl_combination: list
+        Element on each sublattice for every endmember, in the order of template_configuration
+
     endmembers: list 
         List of structures in pymatgen.Structure
+
+    Examples
+    --------
+    The species follow template_configuration, also beyond three sublattices where H, He, Li, Be
+    are no longer in alphabetical order.
+
+    >>> from pymatgen.core import Lattice, Structure
+    >>> template = Structure(Lattice.cubic(4.0), ['H', 'He', 'Li', 'Be'],
+    ...                      [[0, 0, 0], [0.5, 0.5, 0.5], [0.5, 0.5, 0], [0, 0, 0.5]])
+    >>> comb, endmembers = get_endmembers_with_templates(template, ['H', 'He', 'Li', 'Be'],
+    ...                                                  [['Al'], ['Ni'], ['Ti'], ['Fe', 'Co']])
+    >>> comb
+    [['Al', 'Ni', 'Ti', 'Fe'], ['Al', 'Ni', 'Ti', 'Co']]
+    >>> [str(sp) for sp in endmembers[1].species]
+    ['Al', 'Ni', 'Ti', 'Co']
     """
-    element_dict=dict(map(lambda x, y: [x, y], template_configuration, sublattice_configuration))
-    subl_combination=[]
-    for comb in product(*map(element_dict.get, sorted(element_dict))):
-        subl_combination.append(list(comb))
-    endmembers=[]
-    for i in subl_combination:
-        endmembers.append(substitute_configuration(template_structure, [template_configuration], [i]))
+    # keep the order of template_configuration: sorting the template elements by symbol
+    # (B, Be, C, ..., H, He, Li) would pair sublattices with the wrong template element
+    subl_combination=[list(comb) for comb in product(*sublattice_configuration)]
+    endmembers=[substitute_configuration(template_structure, [template_configuration], [i]) for i in subl_combination]
     return subl_combination, endmembers
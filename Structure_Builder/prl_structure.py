@@ -1,6 +1,22 @@
 from pymatgen.core import Structure
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from collections import Counter
+import copy
+
+from structure_tools import deepcopy_structure
+
+
+def _canonicalize_sublattice(sl):
+    """Return a single-species sublattice as the bare species, e.g. ['A'] -> 'A' as in ESPEI format"""
+    return sl[0] if len(sl) == 1 else sl
+
+
+def _freeze(x):
+    """Return nested lists as nested tuples so they can be hashed"""
+    if isinstance(x, list):
+        return tuple(_freeze(y) for y in x)
+    return x
+
 
 class PRLStructure(Structure):
     """A pymatgen Structure object, with some customizations for ESPEI.
@@ -28,6 +44,13 @@ class PRLStructure(Structure):
         self.wyckoff_sites = kwargs.pop('wyckoff_sites', None)
         super(PRLStructure, self).__init__(*args, **kwargs)
 
+    def __deepcopy__(self, memo):
+        return deepcopy_structure(self, memo,
+                                  sublattice_configuration=copy.deepcopy(self.sublattice_configuration, memo),
+                                  sublattice_occupancies=copy.deepcopy(self.sublattice_occupancies, memo),
+                                  sublattice_site_ratios=copy.deepcopy(self.sublattice_site_ratios, memo),
+                                  wyckoff_sites=copy.deepcopy(self.wyckoff_sites, memo))
+
     def __eq__(self, other):
         """
         self and other are equivalent if the sublattice models are equal
@@ -38,29 +61,34 @@ class PRLStructure(Structure):
         """
         if not isinstance(other, PRLStructure):
             return False
-        subl_config = self.sublattice_configuration == other.sublattice_configuration
-        subl_site_ratios = self.sublattice_site_ratios == other.sublattice_site_ratios
-        subl_occupancies = self.sublattice_occupancies == other.sublattice_occupancies
-        wyckoff_sites = self.wyckoff_sites == other.wyckoff_sites
-        return subl_config and subl_site_ratios and subl_occupancies and wyckoff_sites
+        return self.sublattice_key == other.sublattice_key
+
+    @property
+    def sublattice_key(self):
+        """
+        Return a hashable (configuration, site ratios, occupancies, wyckoff sites) tuple of the sublattice model
+
+        PRLStructure itself is mutable and therefore not hashable (like pymatgen's Structure), so use
+        this key to deduplicate structures, e.g. `{s.sublattice_key: s for s in structures}`.
+        The key is rebuilt on every access because the sublattice attributes are reassigned after
+        construction, e.g. in `from_structure` and `reindex`.
+        """
+        return (_freeze(self.sublattice_configuration), _freeze(self.sublattice_site_ratios),
+                _freeze(self.sublattice_occupancies), _freeze(self.wyckoff_sites))
 
     @property
     def espei_sublattice_configuration(self):
         """
         Return ESPEI-formatted sublattice model [['a', 'b'], 'a'] for the concrete case
         """
-        # short function to convert [['A', 'B'], ['A']] to [['A', 'B'], 'A'] as in ESPEI format
-        canonicalize_sublattice = lambda sl: sl[0] if len(sl) == 1 else sl
-        return [canonicalize_sublattice(sl) for sl in self.sublattice_configuration]
+        return [_canonicalize_sublattice(sl) for sl in self.sublattice_configuration]
 
     @property
     def espei_sublattice_occupancies(self):
         """
         Return ESPEI-formatted sublattice occupancies [[0.3333, 0.6666], 1] for the concrete case
         """
-        # short function to convert [[0.3333, 0.6666], [1]] to [[0.3333, 0.6666], 1] as in ESPEI format
-        canonicalize_sublattice = lambda sl: sl[0] if len(sl) == 1 else sl
-        return [canonicalize_sublattice(sl) for sl in self.sublattice_occupancies]
+        return [_canonicalize_sublattice(sl) for sl in self.sublattice_occupancies]
 
     def as_dict(self, verbosity=1, fmt=None, **kwargs):
         d = super(PRLStructure, self).as_dict(verbosity=verbosity, fmt=fmt, **kwargs)
@@ -95,12 +123,11 @@ class PRLStructure(Structure):
         PRLStructure
         """
         struct = PRLStructure.from_dict(structure.as_dict())
-        # normalize the input structure to a pure element to get Wyckoff sites
-        structure = Structure.from_dict(structure.as_dict())
-#        structure.replace_species({sp.name: "H" for sp in structure.species})
-        sga = SpacegroupAnalyzer(structure)
-        wyckoff_sites = sga.get_symmetry_dataset()['wyckoffs']
-        equal_atom = sga.get_symmetry_dataset()['equivalent_atoms']
+        # the symmetry is taken from the new PRLStructure, the input structure is left untouched
+        sga = SpacegroupAnalyzer(struct)
+        symmetry_dataset = sga.get_symmetry_dataset()
+        wyckoff_sites = symmetry_dataset['wyckoffs']
+        equal_atom = symmetry_dataset['equivalent_atoms']
         num_wyckoff_sites = sorted(set(wyckoff_sites))
         num_eq_atom=sorted(set(equal_atom))
         if num_wyckoff_sites == num_eq_atom:
@@ -122,36 +149,30 @@ class PRLStructure(Structure):
             replace_dict=dict(zip(num_eq_atom, replace_list))
             true_sites=[replace_dict[i] for i in equal_atom]
         true_sublattices = sorted(set(true_sites))
+        # map each Wyckoff site to the name of the combined sublattice it belongs to
+        combined_sublattice = {}
         if equivalent_sites is not None:
             # transform the true sublattices by combining equivalent sites
-            combined_sublattices = ['-'.join(sorted(sites)) for sites in equivalent_sites]
-            def match_subl(candidate):
-                for subl in combined_sublattices:
-                    # if the candidate site is in the combined sublattice, return the combined sublattice
-                    if candidate in subl:
-                        return subl
-                # no match found
-                return candidate
-
-            new_subl_model = sorted(set([match_subl(subl) for subl in true_sublattices]))
+            for sites in equivalent_sites:
+                combined_name = '-'.join(sorted(sites))
+                for site in sites:
+                    combined_sublattice[site] = combined_name
+            new_subl_model = sorted(set([combined_sublattice.get(subl, subl) for subl in true_sublattices]))
         else:
             new_subl_model = true_sublattices
 
         #ratios = [sum([1 if site in subl else 0 for site in wyckoff_sites]) for subl in new_subl_model]
+        # count (sublattice, species) pairs over all sites at once, then split the counts by sublattice
+        site_sublattices = [combined_sublattice.get(wyckoff_site, wyckoff_site) for wyckoff_site in true_sites]
+        site_species = [sp.name.upper() for sp in struct.species]
+        subl_species_frequency = {subl: {} for subl in new_subl_model}
+        for (subl, species), count in Counter(zip(site_sublattices, site_species)).items():
+            subl_species_frequency[subl][species] = count
         config = []
         occ = []
         ratios = []
         for subl in new_subl_model:
-            species_frequency_dict = {}
-            for site, wyckoff_site in zip(struct.sites, true_sites):
-                if '-' in subl:
-                    if wyckoff_site in subl:
-                        species=site.specie.name.upper()
-                        species_frequency_dict[species] = species_frequency_dict.get(species, 0) + 1
-                else:
-                    if wyckoff_site == subl:
-                        species = site.specie.name.upper()
-                        species_frequency_dict[species] = species_frequency_dict.get(species, 0) + 1
+            species_frequency_dict = subl_species_frequency[subl]
             total_subl_occupation = sum(species_frequency_dict.values())
             subl_species = sorted(set(species_frequency_dict.keys()))
             subl_occpancy = [species_frequency_dict[sp]/total_subl_occupation for sp in subl_species]
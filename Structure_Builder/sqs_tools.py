@@ -9,9 +9,14 @@ from __future__ import division
 
 import copy
 import itertools
+import math
+from collections import Counter, defaultdict
 
-import pymatgen as pmg
 from pymatgen.core import Structure
+from pymatgen.core.periodic_table import Element
+
+from prl_structure import PRLStructure
+from structure_tools import density_of_solid, deepcopy_structure, scale_to_volume
 
 
 class AbstractSQS(Structure):
@@ -36,26 +41,77 @@ class AbstractSQS(Structure):
         self._sublattice_names = kwargs.pop('sublattice_names', None)
         super(AbstractSQS, self).__init__(*args, **kwargs)
 
+    def __deepcopy__(self, memo):
+        return deepcopy_structure(self, memo,
+                                  sublattice_model=copy.deepcopy(self.sublattice_model, memo),
+                                  sublattice_names=copy.deepcopy(self._sublattice_names, memo))
+
+    @property
+    def _specie_keys(self):
+        """Abstract species name of each specie in each sublattice, e.g. [['Xaa', 'Xab'], ['Xca']]"""
+        return [['X'+name+e for e in subl] for subl, name in zip(self.sublattice_model, self._sublattice_names)]
+
+    @property
+    def _composition_keys(self):
+        """Composition dict keys of each specie in each sublattice, e.g. [['Xaa0+', 'Xab0+'], ['Xca0+']]"""
+        return [[key+'0+' for key in subl_keys] for subl_keys in self._specie_keys]
+
+    @property
+    def _specie_site_counts(self):
+        """Number of sites of each abstract specie, keyed like the composition dict, e.g. {'Xaa0+': 2}"""
+        # counting the sites directly avoids building (and reducing) a pymatgen Composition
+        counts = Counter(str(specie) for specie in self.species)
+        return {k if k.endswith('0+') else k+'0+': v for k, v in counts.items()}
+
     @property
     def normalized_sublattice_site_ratios(self):
         """Return normalized sublattice site ratio. E.g. [[0.25, 0.25], [0.1666, 0.1666, 0.1666]]
         """
-        subl_model = self.sublattice_model
-        subl_names = self._sublattice_names
-        comp_dict = self.composition.as_dict()
-        site_ratios = [[comp_dict['X'+name+e+'0+']/self.num_sites for e in subl] for subl, name in zip(subl_model, subl_names)]
+        comp_dict = self._specie_site_counts
+        site_ratios = [[comp_dict[key]/self.num_sites for key in subl_keys] for subl_keys in self._composition_keys]
         return site_ratios
 
     @property
     def sublattice_site_ratios(self):
         """Return normalized sublattice site ratio. E.g. [[0.25, 0.25], [0.1666, 0.1666, 0.1666]]
         """
-        subl_model = self.sublattice_model
-        subl_names = self._sublattice_names
-        comp_dict = {k: int(v) for k, v in self.composition.reduced_composition.as_dict().items()}
-        site_ratios = [[comp_dict['X'+name+e+'0+'] for e in subl] for subl, name in zip(subl_model, subl_names)]
+        return self._site_ratios_from_counts(self._specie_site_counts)
+
+    def _site_ratios_from_counts(self, site_counts):
+        """Reduce the site counts of self._specie_site_counts to the integer site ratios of each sublattice."""
+        factor = math.gcd(*site_counts.values())
+        comp_dict = {k: v//factor for k, v in site_counts.items()}
+        site_ratios = [[comp_dict[key] for key in subl_keys] for subl_keys in self._composition_keys]
         return site_ratios
 
+    def _canonical_configuration_occupancies(self, subl_model, sublattice_site_ratios):
+        """Return the hashable (configuration, occupancies) the concrete SQS of subl_model will have.
+
+        Parameters
+        ----------
+        subl_model : [[str]]
+            List of strings of species names. Must exactly match the shape of self.sublattice_model.
+        sublattice_site_ratios : [[int]]
+            Site ratios of the abstract species, as returned by self.sublattice_site_ratios.
+
+        Returns
+        -------
+        tuple
+            Tuple of (sublattice configuration, sublattice occupancies) as nested tuples,
+            e.g. ((('FE', 'NI'), ('FE',)), ((0.3333, 0.6666), (1.0,)))
+        """
+        sublattice_configuration = []
+        sublattice_occupancies = []
+        for concrete_subl, subl_ratios in zip(subl_model, sublattice_site_ratios):
+            sublattice_ratio_sum = sum(subl_ratios)
+            sublattice_occupancy_dict = defaultdict(float)
+            for concrete_specie, site_ratio in zip(concrete_subl, subl_ratios):
+                sublattice_occupancy_dict[concrete_specie] += site_ratio/sublattice_ratio_sum
+            subl_species = tuple(sorted(sublattice_occupancy_dict))
+            sublattice_configuration.append(subl_species)
+            sublattice_occupancies.append(tuple(sublattice_occupancy_dict[specie] for specie in subl_species))
+        return tuple(sublattice_configuration), tuple(sublattice_occupancies)
+
     def get_concrete_sqs(self, subl_model, scale_volume=True):
         """Modify self to be a concrete SQS based on the sublattice model.
 
@@ -71,50 +127,68 @@ class AbstractSQS(Structure):
             raise ValueError('Concrete sublattice model {} does not match size of abstract sublattice model {}'.format(subl_model, self.sublattice_model))
         if len(subl_model) != len(self.sublattice_model):
             _subl_error()
-
-        # build the replacement dictionary and the site ratios
-        # we have to look up the sublattice names to build the replacement species names
-        replacement_dict = {}
-        site_occupancies = [] # list of [{'FE': 0.3333, 'NI': 0.6666}, {'FE': 1}] for [['FE', 'NI'], ['FE]]
-        for abstract_subl, concrete_subl, subl_name, subl_ratios in zip(self.sublattice_model, subl_model, self._sublattice_names, self.sublattice_site_ratios):
+        for abstract_subl, concrete_subl in zip(self.sublattice_model, subl_model):
             if len(abstract_subl) != len(concrete_subl):
                 _subl_error()
-            sublattice_ratio_sum = sum(subl_ratios)
-            sublattice_occupancy_dict = {}
-            for abstract_specie, concrete_specie, site_ratio in zip(abstract_subl, concrete_subl, subl_ratios):
-                specie = 'X' + subl_name + abstract_specie
-                replacement_dict[specie] = concrete_specie
-                sublattice_occupancy_dict[concrete_specie] = sublattice_occupancy_dict.get(concrete_specie, 0) + site_ratio/sublattice_ratio_sum
-            site_occupancies.append(sublattice_occupancy_dict)
+        # the site ratios depend on the current sites, so they are computed once per call and passed down
+        specie_keys = self._specie_keys
+        site_counts = self._specie_site_counts
+        sublattice_site_ratios = self._site_ratios_from_counts(site_counts)
+        configuration_occupancies = self._canonical_configuration_occupancies(subl_model, sublattice_site_ratios)
+        return self._build_concrete_sqs(subl_model, configuration_occupancies, specie_keys, sublattice_site_ratios,
+                                        site_counts, scale_volume)
+
+    def _build_concrete_sqs(self, subl_model, configuration_occupancies, specie_keys, sublattice_site_ratios, site_counts,
+                            scale_volume=True):
+        """Build the concrete SQS of a sublattice model whose canonical configuration is already known.
+
+        Parameters
+        ----------
+        subl_model : [[str]]
+            List of strings of species names. Must exactly match the shape of self.sublattice_model.
+        configuration_occupancies : tuple
+            Canonical (configuration, occupancies) of subl_model from _canonical_configuration_occupancies.
+        specie_keys : [[str]]
+            Abstract species names of each sublattice, as returned by self._specie_keys.
+        sublattice_site_ratios : [[int]]
+            Site ratios of the abstract species, as returned by self.sublattice_site_ratios.
+        site_counts : dict
+            Number of sites of each abstract specie, as returned by self._specie_site_counts.
+        scale_volume : bool
+            If True, scales the volume of the cell so the ions have at least their minimum atomic radii between them.
+        """
+        # build the replacement dictionary from the precomputed abstract species names
+        replacement_dict = {}
+        for subl_keys, concrete_subl in zip(specie_keys, subl_model):
+            replacement_dict.update(zip(subl_keys, concrete_subl))
 
         # create a copy of myself to make the transformations and make them
-        self_copy = copy.deepcopy(self)
+        # the lattice and species are immutable, so they can be shared instead of deep copied
+        self_copy = self.copy()
         self_copy.replace_species(replacement_dict)
 
         if scale_volume:
-            fractional_comp = dict(self_copy.composition.fractional_composition)
+            # weight the element densities by their site fractions, which follow from the abstract
+            # site counts and the replacement dict without building a Composition of the copy
             estimated_density = 0
-            for component in self_copy.composition.elements :
-                temp = pmg.core.periodic_table.Element(component).data['Density of solid']
-                density = float(temp.split(' ')[0])
-                estimated_density += (fractional_comp[component] * density)/1000
-            self_copy.scale_lattice(float((self_copy.volume/estimated_density)*self_copy.density))
+            for specie, concrete_specie in replacement_dict.items():
+                estimated_density += site_counts[specie+'0+']/self.num_sites * density_of_solid(concrete_specie)
+            expected_volume = (self_copy.volume/estimated_density)*self_copy.density
+            scale_to_volume(self_copy, expected_volume)
 
         # finally we will construct the SQS object and set the values for the canonicalized
         # sublattice configuration, site ratios, and site occupancies
 
-        # first, canonicalize the sublattice model, e.g. [['FE', 'FE'], ['NI']] => [['FE'], ['NI']]
-        sublattice_configuration = [sorted(set(subl)) for subl in subl_model]
-        # construct the sublattice occupancies for the model
-        sublattice_occupancies = [[occupancies[specie] for specie in subl] for occupancies, subl in zip(site_occupancies, sublattice_configuration)]
+        # the canonical sublattice model, e.g. [['FE', 'FE'], ['NI']] => [['FE'], ['NI']], and its occupancies
+        sublattice_configuration, sublattice_occupancies = configuration_occupancies
         # sum up the individual sublattice site ratios to the total sublattice ratios.
         # e.g [[0.25, 0.25], [0.1666, 0.1666, 0.1666]] => [0.5, 0.5]
-        site_ratios = [sum(ratios) for ratios in self.sublattice_site_ratios]
+        site_ratios = [sum(ratios) for ratios in sublattice_site_ratios]
 
         # create the SQS and add all of these properties to our SQS
         concrete_sqs = PRLStructure.from_sites(self_copy.sites)
-        concrete_sqs.sublattice_configuration = sublattice_configuration
-        concrete_sqs.sublattice_occupancies = sublattice_occupancies
+        concrete_sqs.sublattice_configuration = [list(subl) for subl in sublattice_configuration]
+        concrete_sqs.sublattice_occupancies = [list(subl) for subl in sublattice_occupancies]
         concrete_sqs.sublattice_site_ratios = site_ratios
         return concrete_sqs
 
@@ -132,16 +206,14 @@ class AbstractSQS(Structure):
         Returns:
             spacegroup_symbol, international_number
         """
-        endmember_subl = [['X' + subl_name for _ in subl] for subl, subl_name in
-                          zip(self.sublattice_model, self._sublattice_names)]
-        # we need to replace the abstract names with real names of species.
-        endmember_speices = {specie for subl in endmember_subl for specie in subl}
-        real_species_dict = {abstract_specie: real_specie for abstract_specie, real_specie in
-                             zip(endmember_speices, pmg.core.periodic_table._pt_data.keys())}
-        # replace them
-        endmember_subl = [[real_species_dict[specie] for specie in subl] for subl in endmember_subl]
-        # get the structure and spacegroup info
-        endmember_struct = self.get_concrete_sqs(endmember_subl, scale_volume=False)
+        # we need to replace the abstract names with real names of species, one per sublattice.
+        real_species_dict = {subl_name: str(Element.from_Z(i+1)) for i, subl_name in
+                             enumerate(dict.fromkeys(self._sublattice_names))}
+        endmember_species_dict = {specie: real_species_dict[subl_name] for subl_keys, subl_name in
+                                  zip(self._specie_keys, self._sublattice_names) for specie in subl_keys}
+        # build the endmember directly from the sites, there is no need for a full concrete SQS
+        endmember_struct = Structure(self.lattice, [endmember_species_dict.get(specie.symbol, specie) for specie in self.species],
+                                     self.frac_coords, coords_are_cartesian=False)
         endmember_space_group_info = endmember_struct.get_space_group_info(symprec=symprec, angle_tolerance=angle_tolerance)
         return endmember_space_group_info
 
@@ -150,8 +222,8 @@ class AbstractSQS(Structure):
         d['sublattice_model'] = self.sublattice_model
         d['sublattice_names'] = self._sublattice_names
         d['sublattice_site_ratios'] = self.sublattice_site_ratios
-        endmember_symmetry = self.get_endmember_space_group_info()
-        d['symmetry'] = {'symbol': endmember_symmetry[0], 'number': endmember_symmetry[1]}
+        sg_symbol, sg_number = self.get_endmember_space_group_info()
+        d['symmetry'] = {'symbol': sg_symbol, 'number': sg_number}
         return d
 
     @classmethod
@@ -187,19 +259,24 @@ def enumerate_sqs(structure, subl_model, scale_volume=True, skip_on_failure=Fals
     """
     if len(subl_model) != len(structure.sublattice_model):
         raise ValueError('Passed sublattice model ({}) does not agree with the passed structure ({})'.format(subl_model, structure.sublattice_model))
-    possible_subls = []
-    for subl, abstract_subl in zip(subl_model, structure.sublattice_model):
-        subls = itertools.product(subl, repeat=len(abstract_subl))
-        possible_subls.append(subls)
+    # itertools.product stores its inputs as tuples anyway, so materialize the per-sublattice choices
+    # once up front; the product over the sublattices is then walked lazily
+    possible_subls = [tuple(itertools.product(subl, repeat=len(abstract_subl)))
+                      for subl, abstract_subl in zip(subl_model, structure.sublattice_model)]
     unique_subl_models = itertools.product(*possible_subls)
 
     # create a list of unique concrete structures with the generated sublattice models
+    # models are deduplicated on their canonical configuration before any structure is built
+    # the abstract species names and site ratios are the same for every model, so they are computed once up front
+    specie_keys = structure._specie_keys
+    site_counts = structure._specie_site_counts
+    sublattice_site_ratios = structure._site_ratios_from_counts(site_counts)
     unique_sqs = []
-    unique_configurations_occupancies = []
+    unique_configurations_occupancies = set()
     for model in unique_subl_models:
-        proposed_sqs = structure.get_concrete_sqs(model, scale_volume)
-        proposed_config_occupancy = (proposed_sqs.sublattice_configuration, proposed_sqs.sublattice_occupancies)
+        proposed_config_occupancy = structure._canonical_configuration_occupancies(model, sublattice_site_ratios)
         if proposed_config_occupancy not in unique_configurations_occupancies:
-            unique_configurations_occupancies.append(proposed_config_occupancy)
-            unique_sqs.append(proposed_sqs)
+            unique_configurations_occupancies.add(proposed_config_occupancy)
+            unique_sqs.append(structure._build_concrete_sqs(model, proposed_config_occupancy, specie_keys,
+                                                            sublattice_site_ratios, site_counts, scale_volume))
     return unique_sqs
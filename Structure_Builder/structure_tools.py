@@ -2,7 +2,11 @@
 Tools for substituting structures and generating metadata
 """
 
-from copy import deepcopy
+import copy
+from functools import lru_cache
+from itertools import chain
+from pymatgen.core.periodic_table import Element
+
 def sort_x_by_y(x, y):
     """Sort a list of x in the order of sorting y"""
     return [xx for _, xx in sorted(zip(y, x), key=lambda pair: pair[0])]
@@ -43,10 +47,60 @@ def canonicalize_config(configuration, occupancies):
     ([['Fe', 'Ni'], ['Cr', 'Fe', 'Ni']], [[0.25, 0.75], [0.2, 0.1, 0.7]])
 
     """
-    new_occupancies = [sort_x_by_y(occ, config) for occ, config in zip(occupancies, configuration)]
-    new_configuration = [sorted(config) for config in configuration]
+    new_configuration = []
+    new_occupancies = []
+    for config, occ in zip(configuration, occupancies):
+        # sort each sublattice once and reorder both the species and their occupancies with it
+        order = sorted(range(len(config)), key=config.__getitem__)
+        new_configuration.append([config[i] for i in order])
+        new_occupancies.append([occ[i] for i in order])
     return (new_configuration, new_occupancies)
 
+def deepcopy_structure(structure, memo, **kwargs):
+    """
+    Deep copy a Structure subclass by rebuilding it from its sites rather than deep copying every site object
+
+    Parameters
+    ----------
+        structure : Structure
+            The structure to copy, its class is kept
+        memo : dict
+            The memo dict passed to __deepcopy__
+        kwargs :
+            Extra (already copied) kwargs for the subclass constructor, e.g. the sublattice model
+    Returns
+    -------
+        new : Structure
+            The copied structure, also registered in memo
+    """
+    new = structure.__class__(structure.lattice.copy(), [site.species for site in structure], structure.frac_coords.copy(),
+                              charge=structure._charge, coords_are_cartesian=False,
+                              site_properties=copy.deepcopy(structure.site_properties, memo),
+                              labels=list(structure.labels),
+                              properties=copy.deepcopy(structure.properties, memo), **kwargs)
+    memo[id(structure)] = new
+    return new
+
+@lru_cache(maxsize=None)
+def density_of_solid(ele):
+    """
+    Get density(g/cm^3) of one element, cached as it is looked up for every substituted structure
+
+    Parameters
+    ----------
+        ele : str
+            The element, e.g. 'Nb'
+    Returns
+    -------
+        density : float
+            The density of the solid element, e.g. 8.57
+    Examples
+    --------
+    >>> density_of_solid('Nb')
+    8.57
+    """
+    return float(Element(ele).density_of_solid)/1000.
+
 def get_density_from_pt(ele_list):
     """
     Get density(g/cm^3) from periodictable package
@@ -64,11 +118,8 @@ def get_density_from_pt(ele_list):
     >>> get_density_from_pt(['Nb', 'Ti'])
     {'Nb': 8.57, 'Ti': 4.507}
     """
-    from pymatgen.core.periodic_table import Element
     #import periodictable as pt
-    density_dict = {}
-    for ele in ele_list:
-        density_dict[ele] = float(Element(ele).density_of_solid)/1000.
+    density_dict = {ele: density_of_solid(ele) for ele in ele_list}
     return density_dict
 
 def get_ele_list_from_struct(struct):
@@ -84,11 +135,29 @@ def get_ele_list_from_struct(struct):
         ele_list : [str]
             The list of elements
     """
-    ele_list = []
-    for ele in struct.species:
-        ele_list.append(str(ele))
+    ele_list = list(map(str, struct.species))
     return ele_list
 
+def scale_to_volume(struct, volume):
+    """Scale the lattice of the structure to the volume, unless it already has that volume.
+
+    Parameters
+    ----------
+    struct : pymatgen.Structure
+    volume : float
+        The expected volume of the structure
+
+    Returns
+    -------
+    pymatgen.Structure
+        Modifies the structure in place, but also returns for convenience.
+
+    """
+    # rescaling rebuilds the lattice and every cartesian coordinate, skip it if the volume already fits
+    if abs(volume - struct.volume) > 1e-9*struct.volume:
+        struct.scale_lattice(float(volume))
+    return struct
+
 def scale_struct(struct):
     """Scale the structure according to the weighted average density of each element.
 
@@ -107,14 +176,12 @@ def scale_struct(struct):
 
     """
     species_amnt_dict = struct.composition.get_el_amt_dict()  # dict of {'V': 10.0, 'Ni': 30.0}
-    density_dict = get_density_from_pt(species_amnt_dict)
-    # densities is dict of densities, {'V': 6.313, 'Ni': 9.03}
-    expected_density = float(sum([density_dict[species]*amnt for species, amnt in species_amnt_dict.items()]))/struct.composition.num_atoms
+    # weight the cached element densities, e.g. {'V': 6.313, 'Ni': 9.03}, by amount in a single pass
+    weighted_density = sum(density_of_solid(species)*amnt for species, amnt in species_amnt_dict.items())
+    expected_density = float(weighted_density)/sum(species_amnt_dict.values())
     current_density = struct.density
-    current_volume = struct.volume
-    expected_volume = current_volume/expected_density*current_density
-    struct.scale_lattice(float(expected_volume))
-    return struct
+    expected_volume = struct.volume/expected_density*current_density
+    return scale_to_volume(struct, expected_volume)
 
 def gen_replacement_dict(old_config, new_config):
     """Create a pymatgen replacement dict based on old and new sublattice configurations.
@@ -133,10 +200,8 @@ def gen_replacement_dict(old_config, new_config):
     dict
         Dict of {element_to_replace: new_element}
     """
-    replacement_dict = {}
-    for new_subl, old_subl in zip(new_config, old_config):
-        for new_atom, old_atom in zip(new_subl, old_subl):
-            replacement_dict[old_atom] = new_atom
+    # the shapes match, so the flattened sublattices pair up atom by atom
+    replacement_dict = dict(zip(chain.from_iterable(old_config), chain.from_iterable(new_config)))
     return replacement_dict
 
 
@@ -171,7 +236,8 @@ def substitute_configuration(template_structure, template_config, config, check_
     #        if subl != list(sorted(subl)):
     #            raise ValueError("Configuration {} is not in sorted order. "
     #                             "See information on DFTTK configurations in the docs.".format(config))
-    struct = deepcopy(template_structure)
+    # a shallow copy is enough, the lattice and species are immutable and only the sites are replaced
+    struct = template_structure.copy()
     struct.replace_species(gen_replacement_dict(template_config, config))
     scale_struct(struct)
     return struct